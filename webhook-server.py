@@ -1,13 +1,22 @@
-import argparse, base64, json, signal, sys, yaml
-from datetime import datetime, timezone
-from flask import Flask, jsonify, request, Response
+import argparse, atexit, base64, orjson, os, signal, sys, time, yaml
+from functools import partial
+from flask import Flask, abort, request, Response
+import gevent
+from gevent.pool import Pool
 from gevent.pywsgi import WSGIServer
 from gevent import signal as gevent_signal
 from kubernetes import client, config
-from kubernetes.client.exceptions import ApiException
+
+try:
+    from yaml import CSafeDumper as _YamlDumper
+except ImportError:
+    from yaml import SafeDumper as _YamlDumper
 
 app = Flask(__name__)
 
+class ORJSONResponse(Response):
+    default_mimetype = "application/json"
+
 parser = argparse.ArgumentParser()
 
 parser.add_argument("-d", "--debug", action="store_true", required=False, help="Dump request and response payloads in JSON format to stderr")
@@ -15,6 +24,7 @@ parser.add_argument("-c", "--cert-file", required=True, help="Location of PEM en
 parser.add_argument("-k", "--key-file", required=True, help="Location of PEM encoded TLS private key file")
 parser.add_argument("-p", "--https-port", type=int, required=True, help="TCP port to bind app server to")
 parser.add_argument("-n", "--namespace", required=True, help="Namespace where the webhook server stores the ConfigMaps referenced by the route reconciler")
+parser.add_argument("-m", "--max-connections", type=int, default=64, required=False, help="Maximum number of HTTPS connections accepted concurrently, including idle keep-alive connections from the API server")
 
 args = parser.parse_args()
 
@@ -28,13 +38,75 @@ def _load_kube_configuration():
 
 kube_configuration = _load_kube_configuration()
 
+# Share one ApiClient across requests so the urllib3 connection pool and model caches are
+# reused instead of being rebuilt for every admission request.
+
+_api_client = client.ApiClient(kube_configuration)
+_v1 = client.CoreV1Api(_api_client)
+atexit.register(_api_client.close)
+
+# Values for the ConfigMap 'populate' key read by the route reconciler DaemonSet.
+_POPULATE_TRUE = 'true'
+_POPULATE_FALSE = 'false'
+
+# Label the route reconciler DaemonSet uses to select ConfigMaps generated by the webhook server.
+
+_CONFIGMAP_LABELS = {"route-whisperer.openinfra.io": ""}
+
+def _ydump(o) -> str:
+    return yaml.dump(o, Dumper=_YamlDumper, default_flow_style=False, sort_keys=True)
+
+# Log output goes through a 64KiB buffer on the stdout file descriptor instead of line-buffered
+# sys.stdout. The buffer is flushed every _LOG_FLUSH_INTERVAL seconds by _flush_log while the
+# server runs, and on exit.
+
+_LOG_FLUSH_INTERVAL = 0.1
+_out = os.fdopen(sys.stdout.fileno(), "wb", buffering=65536, closefd=False)
+atexit.register(_out.flush)
+
+# Seconds-resolution UTC timestamp prefix, reformatted only when the second changes.
+_ts_cache = [0, ""]
+
 def log(message: str, show_date: bool = True) -> None:
     if show_date == True:
-        now_utc = datetime.now(timezone.utc)
-        sys.stdout.write(f"{now_utc:%Y-%m-%d %H:%M:%S.%f} - ")
-    sys.stdout.write(f"{message}\n")
+        t = time.time()
+        sec = int(t)
+        if sec != _ts_cache[0]:
+            _ts_cache[:] = [sec, time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(sec))]
+        us = int((t - sec) * 1_000_000)
+        line = f"{_ts_cache[1]}.{us:06d} - {message}\n"
+    else:
+        line = f"{message}\n"
+    _out.write(line.encode())
 
-def build_response(uid: str, json_patches: list[dict] = None, allowed: bool = True) -> Response:
+def _flush_log() -> None:
+    while True:
+        gevent.sleep(_LOG_FLUSH_INTERVAL)
+        _out.flush()
+
+# Logs message followed by the YAML document returned by dump_cb, but only in debug mode. The
+# callback defers building the YAML until after the debug check.
+
+def dlog(message: str, dump_cb) -> None:
+    if args.debug:
+        log(message)
+        log("---\n" + dump_cb(), show_date=False)
+
+# Server-side apply creates the ConfigMap or updates it in place in a single request. The update
+# case occurs when a ClusterUserDefinedNetwork is deleted and then recreated.
+
+def _apply_configmap(name: str, namespace: str, body: dict) -> None:
+    _v1.patch_namespaced_config_map(
+        name=name,
+        namespace=namespace,
+        body=body,
+        field_manager="route-whisperer",
+        force=True,
+        _content_type="application/apply-patch+yaml"
+    )
+    log(f"APPLIED ConfigMap {name} in namespace {namespace}...")
+
+def build_response(uid: str, json_patches: list[dict] = None, allowed: bool = True, message: str = None) -> Response:
     response = {
         "apiVersion": "admission.k8s.io/v1",
         "kind": "AdmissionReview",
@@ -45,30 +117,71 @@ def build_response(uid: str, json_patches: list[dict] = None, allowed: bool = Tr
     }
 
     if json_patches:
-        response["response"]["patch"] = base64.b64encode(
-            json.dumps(json_patches).encode("utf-8")
-        ).decode("ascii")
+        response["response"]["patch"] = base64.b64encode(orjson.dumps(json_patches)).decode("ascii")
         response["response"]["patchType"] = "JSONPatch"
 
-    if args.debug:
-        log("Dumping AdmissionReview/AdmissionResponse payload YAML...")
-        log("---\n" + yaml.dump(response, default_flow_style=False, sort_keys=True), show_date=False)
+    if message:
+        response["response"]["status"] = {"code": 400, "message": message}
 
-    return jsonify(response)
+    dlog("Dumping AdmissionReview/AdmissionResponse payload YAML...", lambda: _ydump(response))
 
-# Called when a ClusterUserDefinedNetwork is created. Mutates ClusterUserDefinedNetwork by
-# adding a label and creates ConfigMap that route reconciler DaemonSet will use to publish route
-# on specified VRF.
+    return ORJSONResponse(orjson.dumps(response))
+
+# Raises KeyError, TypeError or AttributeError when spec.network.layer2 is missing. A layer2 network
+# without subnets (e.g. ipam.mode: Disabled) returns None.
+
+def _get_subnets(object: dict) -> list:
+    return object["spec"]["network"]["layer2"].get("subnets")
+
+# Shared by CREATE and DELETE. Reads the ClusterUserDefinedNetwork subnets from obj_key and
+# applies the ConfigMap the route reconciler DaemonSet uses to publish (populate='true') or
+# remove (populate='false') routes on the specified VRF. When emit_patch is set, the
+# ClusterUserDefinedNetwork is also mutated to reference the ConfigMap. When deny_missing is set,
+# a ClusterUserDefinedNetwork without spec.network.layer2 is denied instead of allowed unchanged.
 
-def handle_create(admission_request: dict) -> Response:
+def _reconcile(admission_request: dict, *, populate: str, obj_key: str, emit_patch: bool, deny_missing: bool) -> Response:
+    uid = admission_request.get('uid')
     cudn_name = admission_request.get('name')
     namespace = args.namespace
-    object = admission_request.get('object') or {}
-    subnets = object.get('spec').get('network').get('layer2').get('subnets')
+    object = admission_request.get(obj_key) or {}
 
-    if args.debug:
-        log(f"DEBUG: Found ClusterUserDefinedNetwork {cudn_name} with the following subnets:")
-        log("---\n" + yaml.dump(subnets, default_flow_style=False, sort_keys=True), show_date=False)
+    try:
+        subnets = _get_subnets(object)
+    except (KeyError, TypeError, AttributeError):
+        # Nothing was published for a ClusterUserDefinedNetwork that is not layer2 (e.g. a
+        # Layer3 or Localnet topology), so there is nothing to remove on DELETE.
+        if not deny_missing:
+            log(f"ClusterUserDefinedNetwork {cudn_name} has no spec.network.layer2, nothing to remove...")
+            return build_response(uid=uid)
+
+        log(f"ERROR: ClusterUserDefinedNetwork {cudn_name} has no spec.network.layer2, denying request...")
+        return build_response(
+            uid=uid,
+            allowed=False,
+            message="spec.network.layer2 is required"
+        )
+
+    subnets_json = orjson.dumps(subnets).decode()
+
+    dlog(f"DEBUG: Found ClusterUserDefinedNetwork {cudn_name} with the following subnets:", lambda: _ydump(subnets))
+
+    configmap = {
+        "apiVersion": "v1",
+        "kind": "ConfigMap",
+        "metadata": {
+            "name": cudn_name,
+            "labels": _CONFIGMAP_LABELS
+        },
+        "data": {
+            'subnets': subnets_json,
+            'populate': populate
+        }
+    }
+
+    _apply_configmap(name=cudn_name, namespace=namespace, body=configmap)
+
+    if not emit_patch:
+        return build_response(uid=uid)
 
     # Add label route-whisperer.openinfra.io/configmap=$cudn_name to ClusterUserDefinedNetwork.
     # This validates the webhook has created the ConfigMap and serves as a reference.
@@ -79,106 +192,38 @@ def handle_create(admission_request: dict) -> Response:
         "value": cudn_name
     }]
 
-    with client.ApiClient(kube_configuration) as api_client:
-        v1 = client.CoreV1Api(api_client)
-
-        configmap = client.V1ConfigMap(
-            metadata=client.V1ObjectMeta(
-                labels={"route-whisperer.openinfra.io": ""},
-                name=cudn_name
-            ),
-            data={
-                'subnets': json.dumps(subnets, separators=(',', ':')),
-                'populate': 'true'
-            }
-        )
+    dlog("DEBUG: Dumping json_patches as YAML...", lambda: _ydump(json_patches))
 
-        # More often than not we are creating a ConfigMap, so just try that first. If the ConfigMap
-        # already exists (409 Conflict), update it instead. This scenario would occur when a
-        # ClusterUserDefiendNetwork is deleted and then recreated. Otherwise raise the exception. 
+    return build_response(
+        uid=uid,
+        json_patches=json_patches
+    )
 
-        try:
-            v1.create_namespaced_config_map(namespace=namespace, body=configmap)
-            log(f"CREATED ConfigMap {cudn_name} in namespace {namespace}...")
-        except ApiException as e:
-            if e.status == 409:
-                v1.patch_namespaced_config_map(
-                    name=cudn_name,
-                    namespace=namespace,
-                    body={
-                        'data':{
-                            'subnets': json.dumps(subnets, separators=(',', ':')),
-                            'populate':'true'
-                        }
-                    }
-                )
-                log(f"UPDATED ConfigMap {cudn_name} in namespace {namespace}...")
-            else:
-                raise
-
-        if args.debug:
-            log(f"DEBUG: Dumping json_patches as YAML...")
-            log("---\n" + yaml.dump(json_patches, default_flow_style=False, sort_keys=True), show_date=False)
+# Called when a ClusterUserDefinedNetwork is created. Mutates ClusterUserDefinedNetwork by
+# adding a label and creates ConfigMap that route reconciler DaemonSet will use to publish route
+# on specified VRF.
 
-        return build_response(
-            uid=admission_request.get('uid'),
-            json_patches=json_patches
-        )
+handle_create = partial(_reconcile, populate=_POPULATE_TRUE, obj_key='object', emit_patch=True, deny_missing=True)
 
 # Called when a ClusterUserDefinedNetwork is deleted. ConfigMap for route reconciler DaemonSet
-# is updated to ensure route is removed from specified 
+# is updated to ensure route is removed from specified VRF.
 
-def handle_delete(admission_request: dict) -> Response:
-    cudn_name = admission_request.get('name')
-    namespace = args.namespace
-    object = admission_request.get('oldObject') or {}
-    subnets = object.get('spec').get('network').get('layer2').get('subnets')
+handle_delete = partial(_reconcile, populate=_POPULATE_FALSE, obj_key='oldObject', emit_patch=False, deny_missing=False)
 
-    if args.debug:
-        log(f"Found ClusterUserDefinedNetwork {cudn_name} with the following subnets:")
-        log("---\n" + yaml.dump(subnets, default_flow_style=False, sort_keys=True), show_date=False)
-    
-    with client.ApiClient(kube_configuration) as api_client:
-        v1 = client.CoreV1Api(api_client)
-
-        configmap = client.V1ConfigMap(
-            metadata=client.V1ObjectMeta(
-                labels={"route-whisperer.openinfra.io": ""},
-                name=cudn_name
-            ),
-            data={
-                'subnets': json.dumps(subnets, separators=(',', ':')),
-                'populate': 'false'
-            }
-        )
-
-        try:
-            v1.create_namespaced_config_map(namespace=namespace, body=configmap)
-            log(f"CREATED ConfigMap {cudn_name} in namespace {namespace}...")
-        except ApiException as e:
-            if e.status == 409:
-                v1.patch_namespaced_config_map(
-                    name=cudn_name,
-                    namespace=namespace,
-                    body={
-                        'data':{
-                            'subnets': json.dumps(subnets, separators=(',', ':')),
-                            'populate':'false'
-                        }
-                    }
-                )
-                log(f"UPDATED ConfigMap {cudn_name} in namespace {namespace}...")
-            else:
-                raise
+# AdmissionRequest operation -> handler. Any other operation is allowed through unchanged.
 
-    return build_response(uid=admission_request.get('uid'))
+_HANDLERS = {
+    "CREATE": handle_create,
+    "DELETE": handle_delete
+}
 
 def start_whispering() -> None:
     server = WSGIServer(
         listener=("0.0.0.0", args.https_port),
         application=app,
         keyfile=args.key_file,
-        certfile=args.cert_file
+        certfile=args.cert_file,
+        spawn=Pool(args.max_connections)
     )
 
     def _graceful_stop(signum, frame) -> None:
@@ -186,7 +231,12 @@ def start_whispering() -> None:
             server.stop(timeout=5)
         finally:
             server.close()
+
+        flusher.kill()
+        _out.flush()
     
+    flusher = gevent.spawn(_flush_log)
+
     gevent_signal.signal(signal.SIGTERM, _graceful_stop)
     gevent_signal.signal(signal.SIGINT, _graceful_stop)
     log(f"Starting gevent WSGIServer on https://0.0.0.0:{args.https_port}")
@@ -198,19 +248,27 @@ def healthz() -> tuple[str, int]:
 
 @app.route("/mutate", methods=["POST"])
 def mutate() -> Response:
-    admission_review = request.get_json(force=True, silent=False)
+    try:
+        admission_review = orjson.loads(request.get_data(cache=False))
+    except orjson.JSONDecodeError:
+        abort(400, description="Failed to decode AdmissionReview JSON")
+
+    if not isinstance(admission_review, dict):
+        abort(400, description="AdmissionReview must be a JSON object")
+
     admission_request = admission_review.get('request')
 
-    if args.debug:
-        log("DEBUG: Dumping AdmissionReview/AdmissionRequest payload YAML...")
-        log("---\n" + yaml.dump(admission_review, default_flow_style=False, sort_keys=True), show_date=False)
+    if not isinstance(admission_request, dict):
+        abort(400, description="AdmissionReview is missing request")
 
-    if admission_request.get('operation') == 'CREATE':
-        return handle_create(admission_request=admission_request)
-    elif admission_request.get('operation') == 'DELETE':
-        return handle_delete(admission_request=admission_request)
-    else:
-        return build_response(uid=admission_request.get('uid'))
+    dlog("DEBUG: Dumping AdmissionReview/AdmissionRequest payload YAML...", lambda: _ydump(admission_review))
+
+    handler = _HANDLERS.get(admission_request.get('operation'))
+
+    if handler is not None:
+        return handler(admission_request=admission_request)
+
+    return build_response(uid=admission_request.get('uid'))
 
 if __name__ == "__main__":
     start_whispering()